@@ -1,12 +1,21 @@
+import json
+import logging
 import os
 import platform
 import time
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 import re
-import traceback
-from typing import List, Dict, Optional, Tuple
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from multiprocessing.util import Finalize
+from pathlib import Path
+from typing import Iterator, List, Dict, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from seleniumbase import SB
 from pyvirtualdisplay import Display
 
@@ -27,13 +36,194 @@ a3@example.com,pass3,556677
 '
 """
 
+def _env_log_level(name: str, default: int) -> int:
+    """读取日志级别环境变量（如 DEBUG / INFO），无效值回退到 default"""
+    level = logging.getLevelName((os.getenv(name) or "").strip().upper())
+    return level if isinstance(level, int) else default
+
+
+def _env_int(name: str, default: int) -> int:
+    """读取正整数环境变量，缺失或无效时回退到 default"""
+    raw = (os.getenv(name) or "").strip()
+    if not raw:
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        value = 0
+    if value >= 1:
+        return value
+    log.warning(f"⚠️ 环境变量 {name}={raw!r} 无效，使用默认值 {default}")
+    return default
+
+
+logging.basicConfig(
+    level=_env_log_level("KATABUMP_LOG", logging.INFO),
+    format="%(asctime)s %(levelname)s [%(processName)s] %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)],
+)
+log = logging.getLogger("kataBump")
+
 LOGIN_URL = "https://dashboard.katabump.com/login"
 RENEW_URL_TEMPLATE = "https://dashboard.katabump.com/servers/edit?id={server_id}"
+SERVER_API_URL_TEMPLATE = "https://dashboard.katabump.com/api/servers/{server_id}"
+# 接口返回里的到期字段；接口未公开，结果要先与页面上的 Expiry 核对一致才会使用
+EXPIRY_API_FIELD = "expiry"
+
+# 页面选择器
+EMAIL_INPUT = 'input[name="email"]'
+PASSWORD_INPUT = 'input[name="password"]'
+LOGIN_SUBMIT_BTN = 'button[type="submit"]'
+CAPTCHA_IFRAME = "iframe[src*='challenges']"
+EXPIRY_LABEL_XPATH = "//div[contains(text(),'Expiry')]"
+EXPIRY_VALUE_XPATH = EXPIRY_LABEL_XPATH + "/following-sibling::div"
+RENEW_BTN = "button:contains('Renew')"
+RENEW_MODAL = "#renew-modal"
+RENEW_FORM_SUBMIT_JS = "document.querySelector('#renew-modal form').submit();"
+ALERT_DANGER = "div.alert.alert-danger"
+
+# 告警文本清洗 / “未到期”提示匹配（已转小写）
+_WS_RE = re.compile(r"\s+")
+_NOT_YET_MARKER = "renew your server yet"
+
+# 一次 execute_script 取回页面上需要判断的所有状态，代替多次 is_element_visible 往返
+PAGE_STATE_JS = """
+var visible = function (el) { return !!(el && el.getClientRects().length); };
+var expiry = document.evaluate(%(expiry)s, document, null, XPathResult.STRING_TYPE, null).stringValue;
+var alertEl = document.querySelector(%(alert)s);
+return {
+    title: document.title || '',
+    notFound: (document.body ? document.body.innerText : '').toLowerCase().indexOf('not found') >= 0,
+    loginVisible: visible(document.querySelector(%(email)s)),
+    captcha: visible(document.querySelector(%(captcha)s)),
+    expiry: (expiry || '').trim(),
+    renewBtn: Array.from(document.querySelectorAll('button')).some(function (b) {
+        return visible(b) && b.textContent.indexOf('Renew') >= 0;
+    }),
+    alert: visible(alertEl) ? alertEl.innerText.trim() : ''
+};
+""" % {
+    "expiry": json.dumps(EXPIRY_VALUE_XPATH),
+    "alert": json.dumps(ALERT_DANGER),
+    "email": json.dumps(EMAIL_INPUT),
+    "captcha": json.dumps(CAPTCHA_IFRAME),
+}
+
+# 在已登录页面内用 fetch 请求接口（同源，自动带 cookies）；url / field 在调用时填入
+EXPIRY_FETCH_JS = """
+var done = arguments[arguments.length - 1];
+var field = %(field)s;
+fetch(%(url)s, {credentials: 'same-origin', headers: {Accept: 'application/json'}})
+    .then(function (r) { return r.ok ? r.json() : null; })
+    .then(function (j) {
+        if (j && j.data && typeof j.data === 'object') { j = j.data; }
+        done(j && j[field] ? String(j[field]).trim().slice(0, 10) : null);
+    })
+    .catch(function () { done(null); });
+"""
 
 SCREENSHOT_DIR = "screenshots"
-os.makedirs(SCREENSHOT_DIR, exist_ok=True)
+# 只有设置了 KATABUMP_DEBUG 才保存截图
+_DEBUG = bool(os.getenv("KATABUMP_DEBUG"))
+
+# 接口 Expiry 是否已与页面核对（每个 worker 进程各自核对一次）：
+# None 未核对 / True 一致，可直接用接口结果判断是否跳过 / False 不一致，不再请求接口
+_api_expiry_verified: Optional[bool] = None
+
+# 上次读到的 Expiry 缓存（server_id -> YYYY-MM-DD），没到续期日的账号直接跳过，不启动浏览器
+EXPIRY_CACHE_FILE = Path("expiry_cache.json")
+
+# 并发进程数（每个进程一个浏览器 + 一个独立的 Xvfb）
+MAX_WORKERS = _env_int("KATABUMP_WORKERS", 4)
+
+# Telegram 单条消息上限 4096 字符，留一点余量
+TG_MAX_LEN = 4000
+TG_MSG_SEP = "\n\n---\n\n"
+# Telegram 全局限制约 30 条/秒，留余量
+TG_GLOBAL_RATE = 25
+# 同一个 chat 约 1 条/秒
+TG_CHAT_RATE = 1
+# 收到 429 后最多尝试发送的次数
+TG_MAX_ATTEMPTS = 3
+# 429 要求等待超过这个秒数就放弃该条消息，避免拖住整个任务
+TG_MAX_RETRY_AFTER = 60
+
+# 邮箱脱敏用的星号表，按需切片，避免每次重复拼接
+_STARS = "*" * 256
+
+
+def _build_http_session(
+    retry_statuses: Tuple[int, ...] = (429, 500, 502, 503, 504), retries: int = 3
+) -> requests.Session:
+    """复用连接的 Session：retry_statuses 里的状态码最多自动重试 retries 次，并遵守 Retry-After"""
+    retry = Retry(
+        total=retries,
+        backoff_factor=1.0,
+        status_forcelist=list(retry_statuses),
+        allowed_methods=frozenset({"GET", "POST"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    return session
+
+
+# TG 的 429 交给 tg_send 里带令牌桶的重试处理，这里只重试 5xx
+_TG_SESSION = _build_http_session(retry_statuses=(500, 502, 503, 504))
+# 读 Expiry 接口只是尽力而为的捷径：不重试，失败直接回退到页面读取
+_KATABUMP_SESSION = _build_http_session(retry_statuses=(), retries=0)
+
+
+class TokenBucket:
+    """简单令牌桶：rate 个/秒，最多攒 capacity 个；线程安全"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """取一个令牌，没有就等到有为止"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_TG_GLOBAL_BUCKET = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+_TG_CHAT_BUCKETS: Dict[str, TokenBucket] = {}
+_TG_CHAT_BUCKETS_LOCK = threading.Lock()
+
+
+def tg_bucket_for(chat_id: str) -> TokenBucket:
+    """每个 chat_id 一个令牌桶"""
+    with _TG_CHAT_BUCKETS_LOCK:
+        bucket = _TG_CHAT_BUCKETS.get(chat_id)
+        if bucket is None:
+            bucket = _TG_CHAT_BUCKETS[chat_id] = TokenBucket(TG_CHAT_RATE, 1)
+        return bucket
+
+
+def tg_retry_after(resp: requests.Response) -> int:
+    """从 429 响应里取等待秒数：优先 JSON parameters.retry_after，其次 Retry-After 头"""
+    try:
+        return int(resp.json()["parameters"]["retry_after"])
+    except Exception:
+        pass
+    retry_after = resp.headers.get("Retry-After")
+    return int(retry_after) if retry_after and retry_after.isdigit() else 1
 
 
+@lru_cache(maxsize=256)
 def mask_email_keep_domain(email: str) -> str:
     """
     只脱敏 @ 前面的用户名
@@ -43,12 +233,10 @@ def mask_email_keep_domain(email: str) -> str:
         return "***"
 
     name, domain = e.split("@", 1)
-    if len(name) <= 1:
+    if len(name) <= 2:
         name_mask = name or "*"
-    elif len(name) == 2:
-        name_mask = name[0] + name[1]
     else:
-        name_mask = name[0] + ("*" * (len(name) - 2)) + name[-1]
+        name_mask = f"{name[0]}{_STARS[:len(name) - 2]}{name[-1]}"
 
     return f"{name_mask}@{domain}"
 
@@ -60,21 +248,35 @@ def setup_xvfb():
             display = Display(visible=False, size=(1920, 1080))
             display.start()
             os.environ["DISPLAY"] = display.new_display_var
-            print("🖥️ Xvfb 已启动")
+            log.info("🖥️ Xvfb 已启动")
             return display
         except Exception as e:
-            print(f"⚠️ 启动 Xvfb 失败 (非致命): {e}")
+            log.warning(f"⚠️ 启动 Xvfb 失败 (非致命): {e}")
     return None
 
 
+def init_worker():
+    """进程池 initializer：每个 worker 进程启动自己的 Xvfb，进程退出时关闭"""
+    display = setup_xvfb()
+    if display:
+        Finalize(None, display.stop, exitpriority=10)
+
+
+def _ensure_screenshot_dir():
+    os.makedirs(SCREENSHOT_DIR, exist_ok=True)
+
+
 def screenshot(sb, name: str):
-    """保存截图"""
+    """保存截图（仅调试模式）"""
+    if not _DEBUG:
+        return
     try:
+        _ensure_screenshot_dir()
         path = f"{SCREENSHOT_DIR}/{name}"
         sb.save_screenshot(path)
-        print(f"📸 截图已保存: {path}")
+        log.info(f"📸 截图已保存: {path}")
     except Exception as e:
-        print(f"⚠️ 截图失败: {e}")
+        log.warning(f"⚠️ 截图失败: {e}")
 
 
 def tg_send(text: str, token: Optional[str] = None, chat_id: Optional[str] = None):
@@ -85,34 +287,180 @@ def tg_send(text: str, token: Optional[str] = None, chat_id: Optional[str] = Non
         return
 
     url = f"https://api.telegram.org/bot{token}/sendMessage"
-    try:
-        requests.post(
-            url,
-            json={"chat_id": chat_id, "text": text, "disable_web_page_preview": True},
-            timeout=15,
-        ).raise_for_status()
-    except Exception as e:
-        print(f"⚠️ TG 发送失败：{e}")
+    for attempt in range(1, TG_MAX_ATTEMPTS + 1):
+        try:
+            # 先过 chat 限速，再过全局限速
+            tg_bucket_for(chat_id).acquire()
+            _TG_GLOBAL_BUCKET.acquire()
+            resp = _TG_SESSION.post(
+                url,
+                json={"chat_id": chat_id, "text": text, "disable_web_page_preview": True},
+                timeout=15,
+            )
+            if resp.status_code == 429 and attempt < TG_MAX_ATTEMPTS:
+                # 仍被限流：按服务端要求等待后重新排队发送
+                retry_after = tg_retry_after(resp)
+                if retry_after > TG_MAX_RETRY_AFTER:
+                    log.warning(f"⚠️ TG 限流需等待 {retry_after} 秒（超过 {TG_MAX_RETRY_AFTER} 秒），放弃发送")
+                    return
+                log.info(f"⏳ TG 限流，{retry_after} 秒后重试 ({attempt}/{TG_MAX_ATTEMPTS})")
+                time.sleep(retry_after)
+                continue
+            resp.raise_for_status()
+        except Exception as e:
+            log.warning(f"⚠️ TG 发送失败：{e}")
+        return
+
+
+def tg_chunks(msgs: List[str], limit: int = TG_MAX_LEN) -> List[str]:
+    """把多条消息合并成尽量少的几条，每条不超过 limit 字符"""
+    chunks: List[str] = []
+    cur = ""
+    for m in msgs:
+        m = m[:limit]
+        if cur and len(cur) + len(TG_MSG_SEP) + len(m) > limit:
+            chunks.append(cur)
+            cur = m
+        else:
+            cur = f"{cur}{TG_MSG_SEP}{m}" if cur else m
+    if cur:
+        chunks.append(cur)
+    return chunks
 
 
-def get_expiry(sb) -> Optional[str]:
+def tg_flush(token: str, chat_id: str, msgs: List[str]):
+    """按顺序发送某个目的地积攒的消息（合并分块后）"""
+    for text in tg_chunks(msgs):
+        tg_send(text, token, chat_id)
+
+
+def get_expiry(sb, timeout: float = 10) -> Optional[str]:
     """
-    安全获取服务器 Expiry 字符串
+    安全获取服务器 Expiry 字符串（最多等待 timeout 秒直到元素出现）
     """
     try:
-        # 先检查是否存在
-        if sb.is_element_visible("//div[contains(text(),'Expiry')]"):
-            text = sb.get_text("//div[contains(text(),'Expiry')]/following-sibling::div")
-            return text.strip() if text else None
+        # 等待元素出现，页面就绪即返回；直接用返回的元素取文本，少一次查找
+        el = sb.wait_for_element_visible(EXPIRY_VALUE_XPATH, timeout=timeout)
+        text = el.text
+        return text.strip() if text else None
     except Exception:
         pass
     return None
 
 
+def get_page_state(sb) -> Dict:
+    """
+    返回当前页面状态：
+    title / notFound / loginVisible / captcha / expiry / renewBtn / alert
+    """
+    return sb.execute_script(PAGE_STATE_JS) or {}
+
+
+def get_cookie_map(sb) -> Dict[str, str]:
+    """浏览器 cookies 转成 name -> value 字典，后续按名字查找都是 O(1)"""
+    return {c["name"]: c["value"] for c in sb.get_cookies()}
+
+
+def get_expiry_via_api(sb, server_id: str) -> Optional[str]:
+    """
+    带上浏览器登录后的 cookies 直接请求 JSON 接口读取 Expiry，不必渲染整个续期页
+    接口不可用 / 返回格式不对时返回 None，由调用方回退到页面读取，且本进程后续不再请求接口
+    """
+    global _api_expiry_verified
+    try:
+        resp = _KATABUMP_SESSION.get(
+            SERVER_API_URL_TEMPLATE.format(server_id=server_id),
+            cookies=get_cookie_map(sb),
+            # cf_clearance 与 UA 绑定，必须和浏览器一致
+            headers={"User-Agent": sb.get_user_agent(), "Accept": "application/json"},
+            timeout=10,
+        )
+        if resp.status_code != 200:
+            raise ValueError(f"HTTP {resp.status_code}")
+        data = resp.json()
+        if isinstance(data.get("data"), dict):
+            data = data["data"]
+        if not data.get(EXPIRY_API_FIELD):
+            raise ValueError(f"返回中没有 {EXPIRY_API_FIELD} 字段")
+        expiry = str(data[EXPIRY_API_FIELD]).strip()[:10]
+        date.fromisoformat(expiry)
+        return expiry
+    except Exception as e:
+        # 接口不存在 / 被拦截：本进程后续账号不再多请求一次
+        _api_expiry_verified = False
+        log.info(f"ℹ️ Expiry 接口不可用，后续改为页面读取: {e}")
+    finally:
+        # 不同账号共用连接池，但不能共用 cookies
+        _KATABUMP_SESSION.cookies.clear()
+    return None
+
+
+def verify_api_expiry(api_expiry: str, page_expiry: str):
+    """第一次同时拿到接口和页面的 Expiry 时核对一次，结果决定本进程后续是否信任接口"""
+    global _api_expiry_verified
+    if _api_expiry_verified is not None:
+        return
+    _api_expiry_verified = api_expiry == page_expiry
+    if _api_expiry_verified:
+        log.info("✅ 接口 Expiry 与页面一致，后续账号直接使用接口结果")
+    else:
+        log.warning(f"⚠️ 接口 Expiry ({api_expiry}) 与页面 ({page_expiry}) 不一致，不再使用接口结果")
+
+
+def fetch_expiry_in_page(sb, server_id: str) -> Optional[str]:
+    """在当前页面里 fetch 接口读取 Expiry，避免整页刷新；失败返回 None"""
+    script = EXPIRY_FETCH_JS % {
+        "url": json.dumps(SERVER_API_URL_TEMPLATE.format(server_id=server_id)),
+        "field": json.dumps(EXPIRY_API_FIELD),
+    }
+    try:
+        expiry = sb.execute_async_script(script, timeout=10)
+        if expiry:
+            date.fromisoformat(expiry)
+            return expiry
+    except Exception as e:
+        log.warning(f"⚠️ 页面内读取 Expiry 接口失败，改为刷新页面: {e}")
+    return None
+
+
+def wait_for_login_result(sb, timeout: float = 30) -> bool:
+    """提交登录后轮询：登录框消失（成功）或出现错误提示（失败）即返回；返回是否已离开登录页"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        state = get_page_state(sb)
+        if not state.get("loginVisible"):
+            return True
+        if state.get("alert"):
+            log.warning(f"⚠️ 登录页提示: [{state['alert']}]")
+            return False
+        time.sleep(0.25)
+    return False
+
+
+def wait_for_turnstile(sb, timeout: float = 10) -> bool:
+    """轮询 Turnstile 回填的 token，拿到即返回（代替固定 sleep）"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        token = sb.execute_script(
+            "var el = document.querySelector('[name=\"cf-turnstile-response\"]');"
+            "return el ? el.value : '';"
+        )
+        if token:
+            return True
+        time.sleep(0.25)
+    return False
+
+
+@lru_cache(maxsize=64)
+def _renew_open_utc(expiry_str: str) -> datetime:
+    """Expiry (YYYY-MM-DD) -> 可续期开放时间：到期日前一天 00:00 UTC；格式不对抛 ValueError"""
+    d = date.fromisoformat(expiry_str.strip())
+    return datetime(d.year, d.month, d.day, tzinfo=timezone.utc) - timedelta(days=1)
+
+
 def renew_open_utc_from_expiry(expiry_str: str) -> datetime:
     try:
-        d = datetime.strptime(expiry_str.strip(), "%Y-%m-%d").date()
-        return datetime(d.year, d.month, d.day, tzinfo=timezone.utc) - timedelta(days=1)
+        return _renew_open_utc(expiry_str)
     except ValueError:
         # 如果格式不对，返回一个默认时间
         return datetime.now(timezone.utc)
@@ -126,41 +474,98 @@ def should_renew_utc0(expiry_str: str, now_utc: datetime = None) -> bool:
         return False
         
     try:
-        expiry_date = datetime.strptime(expiry_str.strip(), "%Y-%m-%d").date()
+        renew_open_utc = _renew_open_utc(expiry_str)
     except ValueError:
-        print(f"⚠️ 日期格式解析错误: {expiry_str}")
+        log.warning(f"⚠️ 日期格式解析错误: {expiry_str}")
         return False
 
-    renew_open_utc = datetime(expiry_date.year, expiry_date.month, expiry_date.day, tzinfo=timezone.utc) - timedelta(days=1)
     now_utc = now_utc or datetime.now(timezone.utc)
 
-    print(f"🕒 now_utc        = {now_utc.strftime('%Y-%m-%d %H:%M')} UTC")
-    print(f"🕒 renew_open_utc = {renew_open_utc.strftime('%Y-%m-%d %H:%M')} UTC")
+    log.info(f"🕒 now_utc        = {now_utc.strftime('%Y-%m-%d %H:%M')} UTC")
+    log.info(f"🕒 renew_open_utc = {renew_open_utc.strftime('%Y-%m-%d %H:%M')} UTC")
 
     if now_utc >= renew_open_utc:
         return True
 
     delta = renew_open_utc - now_utc
     mins = int(delta.total_seconds() // 60)
-    print(f"⏳ 距离可续期还差: {mins//60} 小时 {mins%60} 分钟（按 UTC0 点）")
+    log.info(f"⏳ 距离可续期还差: {mins//60} 小时 {mins%60} 分钟（按 UTC0 点）")
     return False
 
 
-def build_accounts_from_env() -> List[Dict[str, str]]:
+def load_expiry_cache() -> Dict[str, str]:
+    """读取 Expiry 缓存，文件不存在或损坏时返回空字典"""
+    try:
+        data = json.loads(EXPIRY_CACHE_FILE.read_text(encoding="utf-8"))
+        return data if isinstance(data, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        log.warning(f"⚠️ 读取 Expiry 缓存失败 (忽略): {e}")
+        return {}
+
+
+def is_valid_expiry(value: Optional[str]) -> bool:
+    """是否为可解析的 YYYY-MM-DD；只有这种值才能写入 / 信任 Expiry 缓存"""
+    try:
+        date.fromisoformat((value or "").strip())
+        return True
+    except ValueError:
+        return False
+
+
+def split_due_accounts(
+    accounts: List[Dict[str, str]], cache: Dict[str, str], now_utc: datetime
+) -> Tuple[Dict[int, Tuple[str, Optional[str], Optional[str]]], List[Tuple[int, Dict[str, str]]]]:
+    """
+    按缓存的 Expiry 把账号分成：确定没到续期日的（直接 SKIP）和需要打开浏览器的
+    缓存值无法解析视为未命中，账号照常打开浏览器
+    返回：({账号序号: SKIP 结果}, [(账号序号, 账号), ...])
+    """
+    skipped: Dict[int, Tuple[str, Optional[str], Optional[str]]] = {}
+    due: List[Tuple[int, Dict[str, str]]] = []
+    for i, acc in enumerate(accounts):
+        cached = cache.get(acc["server_id"])
+        if is_valid_expiry(cached) and not should_renew_utc0(cached, now_utc):
+            skipped[i] = ("SKIP", cached, None)
+        else:
+            due.append((i, acc))
+    return skipped, due
+
+
+def update_expiry_cache(
+    cache: Dict[str, str], server_id: str, status: str, before: Optional[str], after: Optional[str]
+):
+    """记录最新 Expiry（续期成功且日期已刷新时用新日期）；无法解析的值不写入"""
+    latest_expiry = after if status == "OK" and after else before
+    if status != "FAIL" and is_valid_expiry(latest_expiry):
+        cache[server_id] = latest_expiry.strip()
+
+
+def save_expiry_cache(cache: Dict[str, str]):
+    """一次性写回 Expiry 缓存"""
+    try:
+        EXPIRY_CACHE_FILE.write_text(json.dumps(cache, indent=2, sort_keys=True), encoding="utf-8")
+    except Exception as e:
+        log.warning(f"⚠️ 写入 Expiry 缓存失败: {e}")
+
+
+def iter_accounts_from_env() -> Iterator[Dict[str, str]]:
+    """逐行解析 KATABUMP_BATCH，格式错误的行跳过，有效账号逐个 yield"""
     batch = (os.getenv("KATABUMP_BATCH") or "").strip()
     if not batch:
         raise RuntimeError("❌ 缺少环境变量：请设置 KATABUMP_BATCH")
 
-    accounts: List[Dict[str, str]] = []
     for idx, raw in enumerate(batch.splitlines(), start=1):
         line = raw.strip()
         if not line or line.startswith("#"):
             continue
 
+        # 各字段在这里统一 strip，后面直接使用
         parts = [p.strip() for p in line.split(",")]
 
         if len(parts) not in (3, 5):
-            print(f"⚠️ 跳过格式错误的行 ({idx}): {raw}")
+            log.warning(f"⚠️ 跳过格式错误的行 ({idx}): {raw}")
             continue
 
         email, password, server_id = parts[0], parts[1], parts[2]
@@ -168,242 +573,338 @@ def build_accounts_from_env() -> List[Dict[str, str]]:
         tg_chat = parts[4] if len(parts) == 5 else ""
 
         if not email or not password or not server_id:
-            print(f"⚠️ 跳过空字段行 ({idx}): {raw}")
+            log.warning(f"⚠️ 跳过空字段行 ({idx}): {raw}")
             continue
 
-        accounts.append({
+        yield {
             "email": email,
             "password": password,
             "server_id": server_id,
             "tg_token": tg_token,
             "tg_chat": tg_chat,
-        })
-
-    if not accounts:
-        raise RuntimeError("❌ KATABUMP_BATCH 里没有有效账号行")
+        }
 
-    return accounts
 
-
-def renew_one_account(email: str, password: str, server_id: str) -> Tuple[str, Optional[str], Optional[str]]:
+def renew_one_account(
+    sb, email: str, password: str, server_id: str, now_utc: Optional[datetime] = None
+) -> Tuple[str, Optional[str], Optional[str]]:
     """
-    续期单个账号
+    续期单个账号（复用调用方传入的浏览器会话）
     返回：(status, expiry_before, expiry_after_or_msg)
     """
     renew_url = RENEW_URL_TEMPLATE.format(server_id=server_id)
     expiry_before = None
 
     try:
-        # 使用 uc=True 模式启动浏览器
-        with SB(uc=True, locale="en", test=True) as sb:
-            print("🚀 浏览器启动（UC Mode）")
-
-            # ===== 1. 登录流程 =====
-            print(f"👉 正在登录: {email} ...")
+        # ===== 1. 登录流程 =====
+        log.info(f"👉 正在登录: {email} ...")
+        try:
+            sb.uc_open_with_reconnect(LOGIN_URL, reconnect_time=3.0)
+            # 登录框可见才继续（等不到会抛异常，交给下面的登录状态检查）
+            sb.wait_for_element_visible(EMAIL_INPUT, timeout=15)
+            sb.type(EMAIL_INPUT, email)
+            sb.type(PASSWORD_INPUT, password)
+
+            # 输入完再检查验证码（给 Turnstile 留出挂载时间），尝试处理 Cloudflare 点击
+            if get_page_state(sb).get("captcha"):
+                 log.info("🧩 检测到 CF 验证码，尝试点击...")
+                 sb.uc_gui_click_captcha()
+                 wait_for_turnstile(sb, timeout=10)
+
+            sb.click(LOGIN_SUBMIT_BTN)
+            # 登录框消失即视为已跳转到后台；账号密码错误时页面会给出告警，不必等满超时
+            wait_for_login_result(sb, timeout=30)
+        except Exception as e:
+            log.warning(f"⚠️ 登录过程出现异常: {e}")
+            # 不立即返回，尝试继续，也许已经登录了
+
+        # ===== 2. 检查登录状态 =====
+        if get_page_state(sb).get("loginVisible"):
+            log.error("❌ 登录失败：页面依然在登录框。")
+            screenshot(sb, f"login_fail_{server_id}.png")
+            return "FAIL", None, "Login Failed (Page Stuck)"
+
+        # ===== 3. 先走接口读取 Expiry，没到续期时间就不必打开续期页 =====
+        api_expiry = get_expiry_via_api(sb, server_id) if _api_expiry_verified is not False else None
+        # 只有核对过的接口结果才能用来直接跳过
+        expiry_before = api_expiry if _api_expiry_verified else None
+        if expiry_before:
+            log.info(f"📅 当前 Expiry (API): {expiry_before}")
+            if not should_renew_utc0(expiry_before, now_utc):
+                log.info("ℹ️ 还没到续期时间（按 UTC0 点规则）")
+                return "SKIP", expiry_before, None
+        elif api_expiry:
+            log.info(f"📅 接口返回 Expiry: {api_expiry}（尚未与页面核对，以页面为准）")
+
+        # ===== 4. 进入服务器详情页 =====
+        log.info(f"👉 跳转到服务器页: {server_id} ...")
+        # 登录时已经过了 CF 验证，同站跳转直接 open，不用再断开重连
+        sb.open(renew_url)
+        sb.wait_for_ready_state_complete(timeout=30)
+        state = get_page_state(sb)
+
+        # 检查 404（页面加载完即可判断，不必先等 Expiry）
+        if "404" in state.get("title", "") or state.get("notFound"):
+             log.error("❌ 页面 404：可能是 Server ID 错误。")
+             return "FAIL", expiry_before, "Page 404"
+
+        if not state.get("expiry"):
+            # 等页面主体渲染出来再取一次状态；等不到（布局变更）交给下面的检查
             try:
-                sb.uc_open_with_reconnect(LOGIN_URL, reconnect_time=5.0)
-                time.sleep(3)
-                
-                # 检查是否还在登录页
-                if sb.is_element_visible('input[name="email"]'):
-                    sb.type('input[name="email"]', email)
-                    sb.type('input[name="password"]', password)
-                    
-                    # 尝试处理 Cloudflare 点击
-                    if sb.is_element_visible("iframe[src*='challenges']"):
-                         print("🧩 检测到 CF 验证码，尝试点击...")
-                         sb.uc_gui_click_captcha()
-                         time.sleep(2)
-
-                    sb.click('button[type="submit"]')
-                    sb.wait_for_element_visible("body", timeout=30)
-                    time.sleep(3)
-            except Exception as e:
-                print(f"⚠️ 登录过程出现异常: {e}")
-                # 不立即返回，尝试继续，也许已经登录了
-
-            # ===== 2. 检查登录状态 =====
-            if sb.is_element_visible('input[name="email"]'):
-                print("❌ 登录失败：页面依然在登录框。")
-                screenshot(sb, f"login_fail_{server_id}.png")
-                return "FAIL", None, "Login Failed (Page Stuck)"
-
-            # ===== 3. 进入服务器详情页 =====
-            print(f"👉 跳转到服务器页: {server_id} ...")
-            sb.uc_open_with_reconnect(renew_url, reconnect_time=5.0)
-            sb.wait_for_element_visible("body", timeout=30)
-            time.sleep(3)
-
-            # 检查 404
-            if "404" in sb.get_page_title() or "not found" in (sb.get_text("body") or "").lower():
-                 print("❌ 页面 404：可能是 Server ID 错误。")
-                 return "FAIL", None, "Page 404"
-
-            # ===== 4. 获取当前 Expiry =====
-            expiry_before = get_expiry(sb)
-            
+                sb.wait_for_element_visible(EXPIRY_VALUE_XPATH, timeout=15)
+            except Exception:
+                pass
+            state = get_page_state(sb)
+
+        # ===== 5. 接口结果未核对时，以页面上的 Expiry 为准 =====
+        if not expiry_before:
+            expiry_before = state.get("expiry")
+
             if not expiry_before:
-                print("❌ 未找到 Expiry 元素，可能登录失效或布局变更。")
+                log.error("❌ 未找到 Expiry 元素，可能登录失效或布局变更。")
                 screenshot(sb, f"no_expiry_{server_id}.png")
                 return "FAIL", None, "Expiry Element Not Found"
 
-            print(f"📅 当前 Expiry: {expiry_before}")
+            log.info(f"📅 当前 Expiry: {expiry_before}")
+            if api_expiry:
+                verify_api_expiry(api_expiry, expiry_before)
 
             # 检查是否需要续期
-            if not should_renew_utc0(expiry_before):
-                print("ℹ️ 还没到续期时间（按 UTC0 点规则）")
+            if not should_renew_utc0(expiry_before, now_utc):
+                log.info("ℹ️ 还没到续期时间（按 UTC0 点规则）")
                 return "SKIP", expiry_before, None
 
-            print("🔔 到续期时间，开始续期流程...")
-
-            # ===== 5. 点击 Renew 按钮 =====
-            if not sb.is_element_visible("button:contains('Renew')"):
-                print("❌ 找不到 Renew 按钮")
-                screenshot(sb, f"no_renew_btn_{server_id}.png")
-                return "FAIL", expiry_before, "No Renew Btn"
+        log.info("🔔 到续期时间，开始续期流程...")
 
-            sb.click("button:contains('Renew')")
-            sb.wait_for_element_visible("#renew-modal", timeout=20)
-            time.sleep(2)
-
-            # ===== 6. 处理 Renew Modal 中的 Turnstile =====
-            print("🧩 检查 Modal 验证码...")
+        # ===== 6. 点击 Renew 按钮 =====
+        if not state.get("renewBtn"):
+            # 按钮可能比 Expiry 晚渲染：再等一会儿
             try:
-                # 尝试点击任何可能的验证码 iframe
-                if sb.is_element_visible("iframe[src*='challenges']"):
-                    sb.uc_gui_click_captcha()
-                    time.sleep(4)
-            except Exception as e:
-                print(f"⚠️ captcha 点击异常: {e}")
-
-            # ===== 7. 提交 Renew =====
-            # 使用 JS 强制提交，通常比点击 submit 按钮更稳
-            sb.execute_script("document.querySelector('#renew-modal form').submit();")
-            print("📤 已提交续期请求...")
+                sb.wait_for_element_visible(RENEW_BTN, timeout=10)
+            except Exception:
+                pass
+            state = get_page_state(sb)
+        if not state.get("renewBtn"):
+            log.error("❌ 找不到 Renew 按钮")
+            screenshot(sb, f"no_renew_btn_{server_id}.png")
+            return "FAIL", expiry_before, "No Renew Btn"
+
+        sb.click(RENEW_BTN)
+        sb.wait_for_element_visible(RENEW_MODAL, timeout=20)
+
+        # ===== 7. 处理 Renew Modal 中的 Turnstile =====
+        log.info("🧩 检查 Modal 验证码...")
+        try:
+            # 尝试点击任何可能的验证码 iframe
+            if get_page_state(sb).get("captcha"):
+                sb.uc_gui_click_captcha()
+                wait_for_turnstile(sb, timeout=10)
+        except Exception as e:
+            log.warning(f"⚠️ captcha 点击异常: {e}")
+
+        # ===== 8. 提交 Renew =====
+        # 使用 JS 强制提交，通常比点击 submit 按钮更稳
+        sb.execute_script(RENEW_FORM_SUBMIT_JS)
+        log.info("📤 已提交续期请求...")
+        
+        # 等待结果（表单提交后页面跳转，modal 消失）
+        try:
+            sb.wait_for_element_not_visible(RENEW_MODAL, timeout=10)
+        except Exception:
+            pass
+        sb.wait_for_ready_state_complete(timeout=30)
+
+        # ===== 9. 检查结果/告警 =====
+        alert_text_raw = get_page_state(sb).get("alert")
+        if alert_text_raw:
+            log.info(f"🔎 网站返回告警: [{alert_text_raw}]")
+            screenshot(sb, f"renew_alert_{server_id}.png")
+
+            # 清洗文本以匹配“未到期”提示
+            clean_text = _WS_RE.sub(" ", alert_text_raw).replace("×", "").strip()
+            if _NOT_YET_MARKER in clean_text.lower():
+                return "OK_NOT_YET", expiry_before, alert_text_raw
             
-            # 等待结果（页面可能会刷新或弹出提示）
-            time.sleep(5)
-
-            # ===== 8. 检查结果/告警 =====
-            NOT_YET_SEL = 'div.alert.alert-danger'
-            if sb.is_element_visible(NOT_YET_SEL):
-                alert_text_raw = (sb.get_text(NOT_YET_SEL) or "").strip()
-                print(f"🔎 网站返回告警: [{alert_text_raw}]")
-                screenshot(sb, f"renew_alert_{server_id}.png")
-
-                # 清洗文本以匹配“未到期”提示
-                clean_text = re.sub(r"\s+", " ", alert_text_raw).replace("×", "").strip()
-                if "renew your server yet" in clean_text.lower():
-                    return "OK_NOT_YET", expiry_before, alert_text_raw
-                
-                return "FAIL", expiry_before, alert_text_raw
-
-            # ===== 9. 刷新检查 Expiry 是否更新 =====
+            return "FAIL", expiry_before, alert_text_raw
+
+        # ===== 10. 检查 Expiry 是否更新：先在页面内请求接口，不行再整页刷新 =====
+        expiry_after = fetch_expiry_in_page(sb, server_id) if _api_expiry_verified else None
+        if expiry_after is None:
             try:
                 sb.refresh()
-                sb.wait_for_element_visible("body", timeout=30)
-                time.sleep(3)
+                sb.wait_for_ready_state_complete(timeout=30)
                 expiry_after = get_expiry(sb)
             except Exception:
                 expiry_after = None
 
-            if expiry_after and expiry_after != expiry_before:
-                print(f"🎉 Expiry 已更新: {expiry_before} -> {expiry_after}")
-                return "OK", expiry_before, expiry_after
-
-            print("✅ 流程结束（Expiry 未立即变化，但也未报错）")
+        if expiry_after and expiry_after != expiry_before:
+            log.info(f"🎉 Expiry 已更新: {expiry_before} -> {expiry_after}")
             return "OK", expiry_before, expiry_after
 
+        log.info("✅ 流程结束（Expiry 未立即变化，但也未报错）")
+        return "OK", expiry_before, expiry_after
+
     except Exception as e:
-        print(f"💥 发生严重异常: {e}")
-        traceback.print_exc()
+        # 完整堆栈只在调试模式输出
+        log.error(f"💥 发生严重异常: {e}", exc_info=_DEBUG)
         # 这里的关键修复：返回一个由3个元素组成的元组，避免 main 函数解包失败
         return "FAIL", expiry_before, str(e)
 
 
+def reset_browser_session(sb) -> bool:
+    """
+    清理上一个账号的登录状态，供下一个账号复用同一个浏览器
+    清理失败时重启浏览器；重启也失败返回 False（不能带着上一个账号的登录态继续）
+    """
+    try:
+        # delete_all_cookies 只清当前域名，这里用 CDP 清掉整个浏览器的 cookies
+        sb.driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+        sb.execute_script("window.localStorage.clear(); window.sessionStorage.clear();")
+        sb.uc_open_with_reconnect("about:blank", reconnect_time=1.0)
+        return True
+    except Exception as e:
+        log.warning(f"⚠️ 清理会话失败，重启浏览器: {e}")
+
+    try:
+        sb.get_new_driver(undetectable=True)
+        return True
+    except Exception as e:
+        log.error(f"❌ 重启浏览器失败: {e}")
+        return False
+
+
+def renew_accounts(
+    jobs: List[Tuple[int, Dict[str, str]]], now_utc: Optional[datetime] = None
+) -> List[Tuple[int, Tuple[str, Optional[str], Optional[str]]]]:
+    """
+    进程池 worker：在同一个浏览器会话里依次续期分到的账号，避免每个账号都冷启动 Chrome
+    返回：[(账号序号, (status, expiry_before, expiry_after_or_msg)), ...]
+    """
+    results = []
+    # 使用 uc=True 模式启动浏览器
+    with SB(uc=True, locale="en", test=True) as sb:
+        log.info("🚀 浏览器启动（UC Mode）")
+        for n, (i, acc) in enumerate(jobs):
+            if n and not reset_browser_session(sb):
+                # 无法保证会话干净：本批次剩余账号全部记为失败
+                results.extend((j, ("FAIL", None, "Browser Reset Failed")) for j, _ in jobs[n:])
+                break
+            results.append((i, renew_one_account(sb, acc["email"], acc["password"], acc["server_id"], now_utc)))
+    return results
+
+
+def format_result_msg(
+    status: str, safe_email: str, before: Optional[str], after: Optional[str], now_utc: datetime
+) -> str:
+    """根据单个账号的续期结果生成日志 / TG 消息"""
+    if status == "SKIP":
+        open_utc = renew_open_utc_from_expiry(before) if before else now_utc
+        return (
+            "ℹ️ Katabump 续期跳过 (未到时间)\n"
+            f"账号：{safe_email}\n"
+            f"Expiry：{before}\n"
+            f"开放时间：{open_utc.strftime('%Y-%m-%d %H:%M')} UTC"
+        )
+
+    if status == "OK":
+        if after and after != before:
+            return f"✅ Katabump 续期成功\n账号：{safe_email}\nExpiry：{before} ➜ {after}"
+        return f"✅ Katabump 已提交续期 (日期未立即刷新)\n账号：{safe_email}\nExpiry：{before}"
+
+    if status == "OK_NOT_YET":
+        return (
+            "ℹ️ Katabump 续期跳过 (网站提示未到期)\n"
+            f"账号：{safe_email}\n"
+            f"Expiry：{before}\n"
+            f"提示：{after}"
+        )
+
+    # FAIL
+    return f"❌ Katabump 续期失败\n账号：{safe_email}\n当前Expiry：{before or '未知'}\n错误信息：{after}"
+
+
 def main():
     try:
-        accounts = build_accounts_from_env()
+        # 需要账号总数来分配 worker，这里才物化成列表
+        accounts = list(iter_accounts_from_env())
     except Exception as e:
-        print(e)
+        log.error(e)
         return
 
-    display = setup_xvfb()
+    if not accounts:
+        log.error("❌ KATABUMP_BATCH 里没有有效账号行")
+        return
 
     ok = fail = skip = 0
     not_yet = 0
-    tg_dests = set()
+    # (token, chat_id) -> 待发送消息，结束时每个目的地合并发送
+    tg_buffer: Dict[Tuple[str, str], List[str]] = {}
+    results: Dict[int, Tuple[str, Optional[str], Optional[str]]] = {}
+
+    # 本次运行统一使用同一个“当前时间”，不必每个账号重新取
+    now_utc = datetime.now(timezone.utc)
+
+    # 先用缓存的 Expiry 判断：明确没到续期日的账号不需要启动浏览器
+    expiry_cache = load_expiry_cache()
+    skipped, due = split_due_accounts(accounts, expiry_cache, now_utc)
+    results.update(skipped)
+
+    workers = max(1, min(MAX_WORKERS, len(due)))
+    log.info(f"🚀 共 {len(accounts)} 个账号，需打开浏览器 {len(due)} 个，并发进程数：{workers}")
 
     try:
-        for i, acc in enumerate(accounts, start=1):
-            email = acc["email"]
-            password = acc["password"]
-            server_id = acc["server_id"]
-            tg_token = (acc.get("tg_token") or "").strip()
-            tg_chat = (acc.get("tg_chat") or "").strip()
-            
-            if tg_token and tg_chat:
-                tg_dests.add((tg_token, tg_chat))
+        if due:
+            # 账号轮流分给各个 worker，每个 worker 只启动一次浏览器
+            batches = [due[w::workers] for w in range(workers)]
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as ex:
+                futures = {ex.submit(renew_accounts, jobs, now_utc): jobs for jobs in batches}
+                for fut in as_completed(futures):
+                    try:
+                        results.update(fut.result())
+                    except Exception as e:
+                        # 浏览器启动失败 / worker 进程崩溃：该批次账号全部记为失败，不影响其它批次
+                        for i, _ in futures[fut]:
+                            results.setdefault(i, ("FAIL", None, str(e)))
+
+        for i, acc in enumerate(accounts):
+            email, server_id = acc["email"], acc["server_id"]
+            tg_token, tg_chat = acc["tg_token"], acc["tg_chat"]
 
             safe_email = mask_email_keep_domain(email)
-            print("\n" + "=" * 70)
-            print(f"👤 [{i}/{len(accounts)}] 账号： {safe_email} (ID: {server_id})")
-            print("=" * 70)
+            log.info("=" * 70)
+            log.info(f"👤 [{i + 1}/{len(accounts)}] 账号： {safe_email} (ID: {server_id})")
+            log.info("=" * 70)
 
-            # 调用核心函数
-            status, before, after = renew_one_account(email, password, server_id)
+            status, before, after = results[i]
+
+            update_expiry_cache(expiry_cache, server_id, status, before, after)
 
             # 处理结果
             if status == "SKIP":
                 skip += 1
-                现在_utc = datetime.now(timezone.utc)
-                open_utc = renew_open_utc_from_expiry(before) if before else now_utc
-                msg = (
-                    "ℹ️ Katabump 续期跳过 (未到时间)\n"
-                    f"账号：{safe_email}\n"
-                    f"Expiry：{before}\n"
-                    f"开放时间：{open_utc.strftime('%Y-%m-%d %H:%M')} UTC"
-                )
-            
             elif status == "OK":
                 ok += 1
-                if after and after != before:
-                    msg = f"✅ Katabump 续期成功\n账号：{safe_email}\nExpiry：{before} ➜ {after}"
-                else:
-                    msg = f"✅ Katabump 已提交续期 (日期未立即刷新)\n账号：{safe_email}\nExpiry：{before}"
-            
             elif status == "OK_NOT_YET":
                 not_yet += 1
-                msg = (
-                    "ℹ️ Katabump 续期跳过 (网站提示未到期)\n"
-                    f"账号：{safe_email}\n"
-                    f"Expiry：{before}\n"
-                    f"提示：{after}"
-                )
-            
             else: # FAIL
                 fail += 1
-                msg = f"❌ Katabump 续期失败\n账号：{safe_email}\n当前Expiry：{before or '未知'}\n错误信息：{after}"
-
-            print(msg)
-            tg_send(msg, tg_token, tg_chat)
-
-            # 账号间休息，避免封控
-            if i < len(accounts):
-                print("⏳ 等待 5 秒切换下一个账号...")
-                time.sleep(5)
+            msg = format_result_msg(status, safe_email, before, after, now_utc)
+            log.info(msg)
+            if tg_token and tg_chat:
+                tg_buffer.setdefault((tg_token, tg_chat), []).append(msg)
 
         summary = f"📌 汇总：续期成功 {ok} / 网站提示未到期 {not_yet} / 脚本跳过 {skip} / 失败 {fail}"
-        print("\n" + summary)
+        log.info(summary)
         
-        for token, chat in sorted(tg_dests):
-            tg_send(summary, token, chat)
+        # 不同目的地并发发送（共享 _TG_SESSION 连接池），同一目的地内保持顺序
+        if tg_buffer:
+            with ThreadPoolExecutor(max_workers=min(8, len(tg_buffer))) as ex:
+                list(ex.map(lambda kv: tg_flush(*kv[0], [summary] + kv[1]), tg_buffer.items()))
 
     except KeyboardInterrupt:
-        print("\n🚫 用户中断")
+        log.warning("🚫 用户中断")
     finally:
-        if display:
-            display.stop()
+        save_expiry_cache(expiry_cache)
 
 
 if __name__ == "__main__":
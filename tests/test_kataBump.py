@@ -0,0 +1,78 @@
+import os
+import sys
+import types
+from datetime import datetime, timezone
+
+# 测试环境不装浏览器相关依赖：导入脚本前先放入占位模块
+for _name, _attr in (("seleniumbase", "SB"), ("pyvirtualdisplay", "Display")):
+    if _name not in sys.modules:
+        _mod = types.ModuleType(_name)
+        setattr(_mod, _attr, None)
+        sys.modules[_name] = _mod
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import kataBump_renew_batch as kb  # noqa: E402
+
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def test_should_renew_before_open_time():
+    # 到期日 2026-10-20 -> 2026-10-19 00:00 UTC 开放续期
+    assert kb.should_renew_utc0("2026-10-20", utc(2026, 10, 18, 23, 59)) is False
+
+
+def test_should_renew_at_and_after_open_time():
+    assert kb.should_renew_utc0("2026-10-20", utc(2026, 10, 19, 0, 0)) is True
+    assert kb.should_renew_utc0(" 2026-10-20 ", utc(2026, 10, 21, 12, 0)) is True
+
+
+def test_should_renew_invalid_or_empty_expiry():
+    now = utc(2026, 10, 19)
+    assert kb.should_renew_utc0("", now) is False
+    assert kb.should_renew_utc0(None, now) is False
+    assert kb.should_renew_utc0("20/10/2026", now) is False
+
+
+def test_skip_msg_uses_open_time_from_expiry():
+    msg = kb.format_result_msg("SKIP", "a****f@gmail.com", "2026-10-20", None, utc(2026, 10, 15, 6, 9))
+    assert msg == (
+        "ℹ️ Katabump 续期跳过 (未到时间)\n"
+        "账号：a****f@gmail.com\n"
+        "Expiry：2026-10-20\n"
+        "开放时间：2026-10-19 00:00 UTC"
+    )
+
+
+def test_skip_msg_without_expiry_falls_back_to_now():
+    msg = kb.format_result_msg("SKIP", "a****f@gmail.com", None, None, utc(2026, 10, 15, 6, 9))
+    assert msg.endswith("开放时间：2026-10-15 06:09 UTC")
+
+
+def test_env_int_falls_back_on_invalid_values(monkeypatch):
+    for raw in ("", "abc", "0", "-2", "²"):
+        monkeypatch.setenv("KATABUMP_WORKERS", raw)
+        assert kb._env_int("KATABUMP_WORKERS", 4) == 4
+    monkeypatch.setenv("KATABUMP_WORKERS", " 3 ")
+    assert kb._env_int("KATABUMP_WORKERS", 4) == 3
+
+
+def test_garbage_cache_entry_is_a_cache_miss():
+    accounts = [
+        {"email": "a@b.c", "password": "p", "server_id": "1", "tg_token": "", "tg_chat": ""},
+        {"email": "d@e.f", "password": "p", "server_id": "2", "tg_token": "", "tg_chat": ""},
+    ]
+    cache = {"1": "garbage", "2": "2099-01-01"}
+    skipped, due = kb.split_due_accounts(accounts, cache, utc(2026, 10, 15))
+    assert skipped == {1: ("SKIP", "2099-01-01", None)}
+    assert [i for i, _ in due] == [0]
+
+
+def test_unparseable_expiry_is_not_written_to_cache():
+    cache = {}
+    kb.update_expiry_cache(cache, "1", "SKIP", "Oct 20, 2026", None)
+    kb.update_expiry_cache(cache, "2", "FAIL", "2026-10-20", None)
+    kb.update_expiry_cache(cache, "3", "OK", "2026-10-20", "2026-10-24")
+    assert cache == {"3": "2026-10-24"}